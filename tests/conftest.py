@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app creates its output and cache folders on import, so keep test runs out of the real ones
+os.environ.setdefault("PW_OUTPUT_DIR", tempfile.mkdtemp(prefix="pw-test-outputs-"))
+os.environ.setdefault("PW_CACHE_DIR", tempfile.mkdtemp(prefix="pw-test-cache-"))
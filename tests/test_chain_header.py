@@ -0,0 +1,72 @@
+import os
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+import app
+
+
+def write_chain_workbook(path, rows):
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.title = "Printer Friendly"
+    for row_number, row in enumerate(rows, start=1):
+        for column_number, value in enumerate(row, start=1):
+            if value is not None:
+                worksheet.cell(row=row_number, column=column_number, value=value)
+    workbook.save(path)
+    return str(path)
+
+
+def baseline_header_row(path):
+    """The baseline scan over the whole sheet read with pandas."""
+    CHAIN = pd.read_excel(path, sheet_name="Printer Friendly", header=None)
+    for i in range(len(CHAIN)):
+        if "vendor id" in str(CHAIN.iloc[i, 0]).strip().lower():
+            return i
+    return None
+
+
+DATA_ROWS = [[300100, "100", 12.5], [300101, "KIT-1", 9.0]]
+
+LAYOUTS = {
+    "top": [["Vendor Id", "Sap Product Id", "Net Price"]] + DATA_ROWS,
+    "title_rows": [["Chain Pricing"], ["Printed 2026-10-01"], [], ["  VENDOR ID ", "Sap Product Id"]] + DATA_ROWS,
+    "blank_leading": [[], [], [], [], ["Vendor Id", "Sap Product Id", "Net Price"]] + DATA_ROWS,
+    "blank_first_col": [[None, "Report"], [None, "Chain"], ["Vendor Id", "Sap Product Id"]] + DATA_ROWS,
+    "numeric_first_col": [[1, "x"], [2.5, "y"], ["Vendor ID (SAP)", "Sap Product Id"]] + DATA_ROWS,
+    "missing": [["Supplier", "Sap Product Id"]] + DATA_ROWS,
+}
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "cache_dir", str(tmp_path))
+
+
+@pytest.mark.parametrize("layout", sorted(LAYOUTS))
+def test_header_row_matches_baseline(tmp_path, layout):
+    path = write_chain_workbook(tmp_path / "Chain_Pricing.xlsx", LAYOUTS[layout])
+    header_row, preview = app.find_chain_header_row(path)
+    assert header_row == baseline_header_row(path)
+    assert preview is not None
+
+
+def test_header_row_is_cached_per_source_version(tmp_path):
+    path = write_chain_workbook(tmp_path / "blob-v1.xlsx", LAYOUTS["blank_leading"])
+    assert app.find_chain_header_row(path)[0] == 4
+    assert os.path.exists(tmp_path / "snap-v1-chain-header.json")
+    assert app.find_chain_header_row(path) == (4, None)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+@pytest.mark.parametrize("contents", ['{"header_row": 4', '{"header_row": "4"}', '{"header_row": true}', "[]", ""])
+def test_unreadable_header_cache_is_a_miss(tmp_path, contents):
+    path = write_chain_workbook(tmp_path / "blob-v2.xlsx", LAYOUTS["title_rows"])
+    cache_path = tmp_path / "snap-v2-chain-header.json"
+    cache_path.write_text(contents, encoding="utf-8")
+    header_row, preview = app.find_chain_header_row(path)
+    assert header_row == 3
+    assert preview is not None
+    assert app.find_chain_header_row(path) == (3, None)
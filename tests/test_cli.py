@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def batch_calls(tmp_path, monkeypatch):
+    """Record process_batch calls instead of connecting to SharePoint."""
+    calls = []
+
+    def fake_process_batch(vendor_ids, gp2_threshold, username, password, date_entry, workers=None):
+        calls.append(
+            {
+                "vendor_ids": vendor_ids,
+                "gp2_threshold": gp2_threshold,
+                "username": username,
+                "password": password,
+                "date_entry": date_entry,
+                "workers": workers,
+            }
+        )
+        results = [
+            {"vendor_id": vendor_id, "status": "succeeded", "filename": f"PW_{vendor_id}.xlsx", "message": ""}
+            for vendor_id in vendor_ids or []
+        ]
+        return results, None
+
+    monkeypatch.setattr(app, "process_batch", fake_process_batch)
+    monkeypatch.setattr(app, "output_dir", app.output_dir)
+    monkeypatch.setattr(app, "cache_dir", app.cache_dir)
+    monkeypatch.setenv("PW_SHAREPOINT_PASSWORD", "secret")
+    monkeypatch.setenv("PW_OUTPUT_DIR", os.environ["PW_OUTPUT_DIR"])
+    monkeypatch.setenv("PW_CACHE_DIR", os.environ["PW_CACHE_DIR"])
+    return calls
+
+
+def test_parse_cli_args_defaults():
+    args = app.parse_cli_args(["--vendor", "300100", "--gp2-threshold", "0.25"])
+    assert args.vendors == ["300100"]
+    assert args.gp2_threshold == 0.25
+    assert args.workers is None
+    assert not args.all_vendors
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["--gp2-threshold", "0.25"],
+        ["--vendor", "300100"],
+        ["--vendor", "300100", "--all-vendors", "--gp2-threshold", "0.25"],
+        ["--all-vendors", "--gp2-threshold", "high"],
+    ],
+)
+def test_parse_cli_args_rejects_incomplete_arguments(argv):
+    with pytest.raises(SystemExit):
+        app.parse_cli_args(argv)
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["--all-vendors", "--gp2-threshold", "1.5"],
+        ["--all-vendors", "--gp2-threshold", "0.25", "--workers", "0"],
+        ["--vendor", "300100", "--vendor", "12345", "--gp2-threshold", "0.25"],
+    ],
+)
+def test_invalid_arguments_exit_with_2_before_running(batch_calls, argv):
+    assert app.run_cli(argv + ["--username", "user@example.com"]) == 2
+    assert batch_calls == []
+
+
+def test_missing_credentials_exit_with_2(batch_calls, monkeypatch):
+    monkeypatch.delenv("PW_SHAREPOINT_PASSWORD")
+    monkeypatch.setattr(app.sys.stdin, "isatty", lambda: False, raising=False)
+    assert app.run_cli(["--all-vendors", "--gp2-threshold", "0.25", "--username", "user@example.com"]) == 2
+    assert batch_calls == []
+
+
+def test_vendors_file_skips_blank_and_comment_lines(batch_calls, tmp_path):
+    vendors_file = tmp_path / "vendors.txt"
+    vendors_file.write_text("# weekly\n300100\n\n  300101  \n", encoding="utf-8")
+    argv = ["--vendors-file", str(vendors_file), "--gp2-threshold", "0.3", "--date", "2026-10-01", "--workers", "2"]
+    assert app.run_cli(argv + ["--username", "user@example.com"]) == 0
+    assert batch_calls == [
+        {
+            "vendor_ids": ["300100", "300101"],
+            "gp2_threshold": 0.3,
+            "username": "user@example.com",
+            "password": "secret",
+            "date_entry": "2026-10-01",
+            "workers": 2,
+        }
+    ]
+
+
+def test_all_vendors_passes_none(batch_calls):
+    assert app.run_cli(["--all-vendors", "--gp2-threshold", "0.25", "--username", "user@example.com"]) == 0
+    assert batch_calls[0]["vendor_ids"] is None
+
+
+def test_failed_vendors_exit_with_1(batch_calls, monkeypatch):
+    def failing_process_batch(vendor_ids, *args, **kwargs):
+        return [{"vendor_id": vendor_ids[0], "status": "failed", "filename": None, "message": "No data"}], None
+
+    monkeypatch.setattr(app, "process_batch", failing_process_batch)
+    assert app.run_cli(["--vendor", "300100", "--gp2-threshold", "0.25", "--username", "user@example.com"]) == 1
+
+
+def test_output_dir_is_passed_on_to_batch_workers(batch_calls, tmp_path):
+    argv = ["--vendor", "300100", "--gp2-threshold", "0.25", "--output-dir", str(tmp_path / "out")]
+    assert app.run_cli(argv + ["--username", "user@example.com"]) == 0
+    assert os.environ["PW_OUTPUT_DIR"] == str(tmp_path / "out")
+    assert app.output_dir == str(tmp_path / "out")
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+def baseline_improved_deduplication(df):
+    """The baseline implementation, which tried each strategy with DataFrame.duplicated."""
+    for cols in app.DEDUP_STRATEGIES:
+        existing_cols = [col for col in cols if col in df.columns]
+        if len(existing_cols) >= 2 and df.duplicated(subset=existing_cols).any():
+            return df.drop_duplicates(subset=existing_cols, keep="first")
+    return df.copy()
+
+
+def random_pricing_frame(seed, rows=200, drop=()):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "SAP Product ID": rng.choice(["100", "200", "300", None], rows),
+            "Deal ID": rng.choice([1.0, 2.0, np.nan], rows),
+            "Deal Class": rng.choice(["A", "B"], rows),
+            "Channel": rng.choice(["ON", "OFF", None], rows),
+            "Purchase Quantity": rng.choice([1, 5, 10], rows),
+            "Price Group": rng.choice(["PG1", "PG2", "PG3"], rows),
+            "Start Date": pd.to_datetime(rng.choice(["2026-01-01", "2026-02-01", None], rows)),
+            "End Date": pd.to_datetime(rng.choice(["2026-12-31", None], rows)),
+            "Case Price": rng.random(rows).round(2),
+        },
+        index=rng.permutation(rows) * 3,
+    )
+    return df.drop(columns=list(drop))
+
+
+FRAMES = {
+    "all_columns": random_pricing_frame(0),
+    "first_strategy_unique": random_pricing_frame(1, rows=6).assign(**{"Case Price": range(6), "Deal ID": range(6)}),
+    "no_dates": random_pricing_frame(2, drop=["Start Date", "End Date"]),
+    "no_deal_columns": random_pricing_frame(3, drop=["Deal ID", "Purchase Quantity"]),
+    "price_group_only": random_pricing_frame(4, rows=30, drop=["Deal ID", "Deal Class", "Channel", "Purchase Quantity"]),
+    "single_key_column": random_pricing_frame(5, drop=app.DEDUP_STRATEGIES[0][1:]),
+    "empty": random_pricing_frame(6, rows=0),
+}
+
+
+@pytest.mark.parametrize("name", sorted(FRAMES))
+def test_deduplication_matches_baseline(name):
+    df = FRAMES[name]
+    pd.testing.assert_frame_equal(app.improved_deduplication(df), baseline_improved_deduplication(df))
+
+
+def test_unique_rows_are_kept():
+    df = pd.DataFrame({"SAP Product ID": ["100", "100", "200"], "Price Group": ["PG1", "PG2", "PG1"]})
+    result = app.improved_deduplication(df)
+    pd.testing.assert_frame_equal(result, df)
+    assert result is not df
+
+
+def test_audit_records_each_strategy():
+    df = FRAMES["all_columns"]
+    audit = []
+    result = app.improved_deduplication(df, audit=audit)
+    assert [entry["columns"] for entry in audit] == app.DEDUP_STRATEGIES
+    for entry in audit:
+        assert entry["duplicates"] == int(df.duplicated(subset=entry["columns"]).sum())
+    applied = [entry for entry in audit if entry["applied"]]
+    assert len(applied) == 1
+    assert applied[0] == next(entry for entry in audit if entry["duplicates"])
+    assert len(df) - len(result) == applied[0]["duplicates"]
+
+
+def test_audit_skips_strategies_with_fewer_than_two_columns():
+    audit = []
+    app.improved_deduplication(FRAMES["single_key_column"], audit=audit)
+    assert all(entry["duplicates"] is None and not entry["applied"] for entry in audit)
@@ -0,0 +1,100 @@
+import os
+from datetime import date
+
+import pytest
+
+import app
+
+VERSIONS = {"PB": "pb1", "ZPUR": "zp1", "CHAIN": "ch1"}
+DAY = date(2026, 10, 1)
+
+
+@pytest.fixture(autouse=True)
+def isolated_folders(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "cache_dir", str(tmp_path))
+    monkeypatch.setattr(app, "output_dir", str(tmp_path))
+
+
+def write_result(filename):
+    with open(os.path.join(app.output_dir, filename), "wb") as f:
+        f.write(b"xlsx")
+    return filename
+
+
+def output_exists(filename):
+    return os.path.exists(os.path.join(app.output_dir, filename))
+
+
+def test_cached_result_is_reused_for_the_same_inputs():
+    filename = write_result("PW_300100_20261001.xlsx")
+    app.store_cached_result("300100", 0.25, DAY, VERSIONS, filename)
+    assert app.find_cached_result("300100", 0.25, DAY, dict(VERSIONS)) == filename
+    assert app.find_cached_result("300100", "0.25", DAY, VERSIONS) == filename
+
+
+@pytest.mark.parametrize(
+    "vendor_id, gp2_threshold, date_entry, versions",
+    [
+        ("300101", 0.25, DAY, VERSIONS),
+        ("300100", 0.3, DAY, VERSIONS),
+        ("300100", 0.25, date(2026, 10, 2), VERSIONS),
+        ("300100", 0.25, DAY, dict(VERSIONS, CHAIN="ch2")),
+        ("300100", 0.25, DAY, None),
+    ],
+)
+def test_cached_result_is_not_reused_for_other_inputs(vendor_id, gp2_threshold, date_entry, versions):
+    app.store_cached_result("300100", 0.25, DAY, VERSIONS, write_result("PW_300100_20261001.xlsx"))
+    assert app.find_cached_result(vendor_id, gp2_threshold, date_entry, versions) is None
+
+
+def test_nothing_is_cached_without_source_versions():
+    app.store_cached_result("300100", 0.25, DAY, None, write_result("PW_300100_20261001.xlsx"))
+    assert app.load_result_cache_index() == {}
+
+
+def test_results_of_an_older_format_are_not_reused(monkeypatch):
+    filename = write_result("PW_300100_20261001.xlsx")
+    app.store_cached_result("300100", 0.25, DAY, VERSIONS, filename)
+    monkeypatch.setattr(app, "RESULT_CACHE_FORMAT", app.RESULT_CACHE_FORMAT + 1)
+    assert app.find_cached_result("300100", 0.25, DAY, VERSIONS) is None
+
+
+def test_entries_whose_workbook_is_gone_are_dropped():
+    filename = write_result("PW_300100_20261001.xlsx")
+    app.store_cached_result("300100", 0.25, DAY, VERSIONS, filename)
+    os.remove(os.path.join(app.output_dir, filename))
+    assert app.find_cached_result("300100", 0.25, DAY, VERSIONS) is None
+    assert app.load_result_cache_index() == {}
+
+
+def test_replaced_result_workbook_is_deleted():
+    old = write_result("PW_300100_20261001_1.xlsx")
+    app.store_cached_result("300100", 0.25, DAY, VERSIONS, old)
+    new = write_result("PW_300100_20261001_2.xlsx")
+    app.store_cached_result("300100", 0.25, DAY, dict(VERSIONS, PB="pb2"), new)
+    assert not output_exists(old)
+    assert app.find_cached_result("300100", 0.25, DAY, dict(VERSIONS, PB="pb2")) == new
+    assert list(app.load_result_cache_index()) == [app.result_cache_key("300100", 0.25, DAY)]
+
+
+def test_least_recently_used_results_are_evicted_over_the_limit(monkeypatch):
+    monkeypatch.setattr(app, "RESULT_CACHE_MAX_ENTRIES", 2)
+    filenames = [write_result(f"PW_30010{i}_20261001.xlsx") for i in range(3)]
+    app.store_cached_result("300100", 0.25, DAY, VERSIONS, filenames[0])
+    app.store_cached_result("300101", 0.25, DAY, VERSIONS, filenames[1])
+    assert app.find_cached_result("300100", 0.25, DAY, VERSIONS) == filenames[0]
+    app.store_cached_result("300102", 0.25, DAY, VERSIONS, filenames[2])
+    assert [output_exists(filename) for filename in filenames] == [True, False, True]
+    assert app.find_cached_result("300101", 0.25, DAY, VERSIONS) is None
+
+
+def test_workbooks_being_served_are_not_deleted(monkeypatch):
+    monkeypatch.setattr(app, "RESULT_CACHE_MAX_ENTRIES", 1)
+    served = write_result("PW_300100_20261001.xlsx")
+    app.store_cached_result("300100", 0.25, DAY, VERSIONS, served)
+    monkeypatch.setitem(app.served_files, served, 1)
+    app.store_cached_result("300101", 0.25, DAY, VERSIONS, write_result("PW_300101_20261001.xlsx"))
+    assert output_exists(served)
+    monkeypatch.delitem(app.served_files, served)
+    app.store_cached_result("300102", 0.25, DAY, VERSIONS, write_result("PW_300102_20261001.xlsx"))
+    assert not output_exists(served)
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+def baseline_normalize_sap_ids(values):
+    """The row-wise vendor ID normalization parse_sap_ids replaced."""
+    return (
+        pd.Series(values)
+        .apply(lambda x: str(int(float(x))) if pd.notna(x) and str(x).replace(".", "").isdigit() else "0")
+        .str.zfill(6)
+    )
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        pd.Series(["300100", "300100.0", " 300100", "abc", "", None, "3.001e5", "-5", "42"], dtype=object),
+        pd.Series([300100, 5, 0, -7]),
+        pd.Series([300100.0, np.nan, 5.7, -1.0, 1e16, 123456789012345.0]),
+        pd.Series([300100, "300101", 5.0, None, True], dtype=object),
+        pd.Series([True, False]),
+        pd.Series([], dtype=object),
+    ],
+)
+def test_normalize_sap_ids_matches_baseline(values):
+    assert app.normalize_sap_ids(values).tolist() == baseline_normalize_sap_ids(values).tolist()
+
+
+def test_parse_sap_ids_returns_nullable_integers():
+    ids = app.parse_sap_ids(pd.Series(["300100", "12.9", "x", None], dtype=object))
+    assert str(ids.dtype) == "Int64"
+    assert ids.tolist() == [300100, 12, pd.NA, pd.NA]
+
+
+def merged_fob(pb_ids, zpur_materials):
+    """FOB of each Price Book row after index_source_frames merges it with ZPURCON."""
+    frames = {
+        "PB": pd.DataFrame({"SAP Product ID": pd.Series(pb_ids, dtype=object)}),
+        "ZPUR": pd.DataFrame(
+            {
+                "Material": pd.Series(zpur_materials, dtype=object),
+                "Supplier": 300100,
+                "FOB": np.arange(len(zpur_materials), dtype="float64"),
+            }
+        ),
+        "CHAIN": pd.DataFrame({"Vendor Id": [300100]}),
+    }
+    indexed, error = app.index_source_frames(frames)
+    assert error is None
+    return indexed["PB_merged"]["FOB"].tolist()
+
+
+def baseline_merged_fob(pb_ids, zpur_materials):
+    """The baseline merge on the raw material values."""
+    PB = pd.DataFrame({"SAP Product ID": pd.Series(pb_ids, dtype=object)})
+    ZPUR = pd.DataFrame(
+        {"Material": pd.Series(zpur_materials, dtype=object), "FOB": np.arange(len(zpur_materials), dtype="float64")}
+    )
+    return PB.merge(ZPUR, left_on="SAP Product ID", right_on="Material", how="left")["FOB"].tolist()
+
+
+@pytest.mark.parametrize(
+    "pb_ids, zpur_materials",
+    [
+        (["100", "KIT-1", "200", "300"], ["100", "KIT-1", "BOX", "200"]),
+        ([100, 200, 400], [200, 100, 300]),
+        (["KIT-1", "KIT-2", "100"], ["KIT-2", "KIT-1", "100", "KIT-1"]),
+    ],
+)
+def test_material_merge_matches_baseline_for_identical_spellings(pb_ids, zpur_materials):
+    assert merged_fob(pb_ids, zpur_materials) == pytest.approx(
+        baseline_merged_fob(pb_ids, zpur_materials), nan_ok=True
+    )
+
+
+def test_material_merge_matches_numeric_spellings():
+    assert merged_fob(["100", 200.0, " 300 ", 400], [100, "200", 300.0, "400.0"]) == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_material_merge_leaves_blank_and_unknown_ids_unmatched():
+    fob = merged_fob(["KIT-1", "KIT-9", None, ""], ["KIT-1", "BOX-9", None, "", "KIT-2"])
+    assert len(fob) == 4
+    assert fob[0] == 0.0
+    assert all(np.isnan(value) for value in fob[1:])
+
+
+def test_material_join_keys_share_codes_across_columns():
+    zpur, pb, chain = app.material_join_keys(
+        pd.Series(["KIT-1", "100", None], dtype=object),
+        pd.Series([" KIT-1", "BOX"], dtype=object),
+        pd.Series([100.0, np.nan, 7.0]),
+    )
+    assert all(str(keys.dtype) == "Int64" for keys in (zpur, pb, chain))
+    assert zpur[0] == pb[0] and zpur[0] < 0
+    assert pb[1] < 0 and pb[1] != zpur[0]
+    assert zpur[1] == chain[0] == 100
+    assert zpur.isna().tolist() == [False, False, True]
+    assert chain.isna().tolist() == [False, True, False]
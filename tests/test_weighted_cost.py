@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+def test_single_cost_groups_keep_baseline_cost():
+    # The baseline wrote each row's own Avg Cost; groups with one cost must still do so exactly
+    df = pd.DataFrame(
+        {
+            "Price Group": ["A", "B", "B", "C", "D"],
+            "Avg Cost": [71.88, 13.33, 13.33, 0.1 + 0.2, 19.99],
+            "Cases OH": [3, 7, 0, 11, 0],
+        }
+    )
+    assert app.weighted_average_cost(df).tolist() == df["Avg Cost"].tolist()
+
+
+def test_mixed_cost_groups_are_weighted_by_cases_on_hand_and_rounded_to_cents():
+    df = pd.DataFrame(
+        {
+            "Price Group": ["A", "A", "A", "B", "B"],
+            "Avg Cost": [10.00, 11.00, 12.50, 7.10, 7.15],
+            "Cases OH": [1, 2, 0, 3, 1],
+        }
+    )
+    # A: (10 + 22) / 3 = 10.666..., B: (21.30 + 7.15) / 4 = 7.1125
+    assert app.weighted_average_cost(df).tolist() == [10.67, 10.67, 10.67, 7.11, 7.11]
+
+
+def test_groups_without_cases_on_hand_fall_back_to_first_cost():
+    df = pd.DataFrame({"Price Group": ["A", "A"], "Avg Cost": [9.25, 8.75], "Cases OH": [0, np.nan]})
+    assert app.weighted_average_cost(df).tolist() == [9.25, 9.25]
+
+
+def test_rows_without_a_group_get_nan():
+    df = pd.DataFrame({"Price Group": ["A", None], "Avg Cost": [9.25, 8.75], "Cases OH": [1, 1]})
+    result = app.weighted_average_cost(df)
+    assert result.iloc[0] == 9.25
+    assert np.isnan(result.iloc[1])
+
+
+def test_result_is_aligned_to_the_frame_index():
+    df = pd.DataFrame(
+        {"Price Group": ["A", "B", "A"], "Avg Cost": [1.0, 5.0, 2.0], "Cases OH": [1, 4, 3]},
+        index=[30, 10, 20],
+    )
+    result = app.weighted_average_cost(df)
+    assert result.index.tolist() == [30, 10, 20]
+    assert result.tolist() == pytest.approx([1.75, 5.0, 1.75])